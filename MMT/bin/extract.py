@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import io
 import argparse
 from pathlib import Path
 
@@ -8,13 +9,30 @@ import os
 from PIL import Image
 
 import torch
+import torch.nn as nn
 import torch.nn.functional as F
-from torch.autograd import Variable
 import torch.utils.data as data
 
 from torchvision.models import resnet50
 from torchvision import transforms
 
+try:
+    from nvidia.dali import fn, types
+    from nvidia.dali.pipeline import Pipeline
+    from nvidia.dali.plugin.pytorch import DALIGenericIterator, LastBatchPolicy
+except ImportError:
+    Pipeline = object
+    DALI_AVAILABLE = False
+else:
+    DALI_AVAILABLE = True
+
+try:
+    import tensorrt as trt
+except ImportError:
+    TRT_AVAILABLE = False
+else:
+    TRT_AVAILABLE = True
+
 # This script uses the PyTorch's pre-trained ResNet-50 CNN to extract
 #   res4f_relu convolutional features of size 1024x14x14
 #   avgpool features of size 2048D
@@ -32,6 +50,19 @@ from torchvision import transforms
 #    -f /path/to/images/train  --> train folder contains 29K images
 #                                  and an index.txt with 29K lines.
 #
+# Passing --dali replaces the PIL/torchvision CPU preprocessing with an
+# NVIDIA DALI pipeline which decodes JPEGs with nvJPEG and resizes, crops
+# and normalizes the images on the GPU.
+#
+# Passing --fp16 runs the CNN forward pass under FP16 autocast so that
+# convolutions can use Tensor Cores on Volta and newer GPUs. The model and
+# the inputs are also switched to channels_last (NHWC) memory format to avoid
+# NCHW<->NHWC transpositions around these convolutions. The optional l2
+# normalization is always computed in 32-bit.
+#
+# Passing --trt exports the truncated CNN to ONNX and runs it through a
+# TensorRT FP16 engine built for the fixed (batch_size, 3, width, width) input.
+#
 
 
 class ImageFolderDataset(data.Dataset):
@@ -53,6 +84,7 @@ class ImageFolderDataset(data.Dataset):
 
         # Image list in dataset order
         self.index = index
+        self.resize = resize
 
         _transforms = []
         if resize is not None:
@@ -78,8 +110,12 @@ class ImageFolderDataset(data.Dataset):
 
     def read_image(self, fname):
         with open(fname, 'rb') as f:
-            img = Image.open(f).convert('RGB')
-            return self.transform(img)
+            img = Image.open(f)
+            if self.resize is not None:
+                # Let libjpeg decode at a reduced DCT scale when the image
+                # is much larger than the requested size
+                img.draft('RGB', (self.resize, self.resize))
+            return self.transform(img.convert('RGB'))
 
     def __getitem__(self, idx):
         return self.read_image(self.image_files[idx])
@@ -88,6 +124,126 @@ class ImageFolderDataset(data.Dataset):
         return len(self.image_files)
 
 
+class DALIImagePipeline(Pipeline):
+    """A DALI counterpart of ``ImageFolderDataset`` which performs JPEG
+    decoding (nvJPEG), resizing, center cropping and normalization on the GPU.
+
+    Arguments:
+        image_files (list): List of image filenames in dataset order.
+        batch_size (int): Batch size.
+        resize (int, optional): The shortest side of the image is resized
+            to this value. Default: ``None``.
+        crop (int, optional): Size of the central square crop.
+            Default: ``None``.
+        num_threads (int, optional): Number of CPU threads used by DALI.
+            Default: 4.
+        device_id (int, optional): GPU device to use. Default: 0.
+    """
+    def __init__(self, image_files, batch_size, resize=None, crop=None,
+                 num_threads=4, device_id=0):
+        super().__init__(batch_size, num_threads, device_id)
+        self.image_files = image_files
+        self.resize = resize
+        self.crop = crop
+
+    def define_graph(self):
+        jpegs, _ = fn.readers.file(
+            files=self.image_files, random_shuffle=False, name='Reader')
+        images = fn.decoders.image(jpegs, device='mixed', output_type=types.RGB)
+        if self.resize is not None:
+            images = fn.resize(images, resize_shorter=self.resize)
+
+        cmn_args = {}
+        if self.crop is not None:
+            cmn_args['crop'] = (self.crop, self.crop)
+
+        return fn.crop_mirror_normalize(
+            images, dtype=types.FLOAT, output_layout='CHW',
+            mean=[0.485 * 255, 0.456 * 255, 0.406 * 255],
+            std=[0.229 * 255, 0.224 * 255, 0.225 * 255], **cmn_args)
+
+
+def dali_loader(image_files, batch_size, resize=None, crop=None,
+                num_threads=4, device_id=0):
+    """Yields batches of GPU tensors produced by ``DALIImagePipeline``."""
+    pipe = DALIImagePipeline(
+        image_files, batch_size, resize=resize, crop=crop,
+        num_threads=num_threads, device_id=device_id)
+    pipe.build()
+    iterator = DALIGenericIterator(
+        pipe, ['data'], reader_name='Reader',
+        last_batch_policy=LastBatchPolicy.PARTIAL)
+    for batch in iterator:
+        yield batch[0]['data']
+
+
+class TensorRTExtractor(object):
+    """Runs a truncated ResNet-50 through a TensorRT FP16 engine.
+
+    Arguments:
+        cnn (nn.Module): The CUDA ResNet-50 instance without the ``fc`` layer.
+        layer (str): One of ``res4f_relu``, ``res5c_relu`` or ``avgpool``.
+        batch_size (int): Static batch size of the engine.
+        width (int): Static width and height of the input images.
+    """
+    def __init__(self, cnn, layer, batch_size, width):
+        self.batch_size = batch_size
+        self.logger = trt.Logger(trt.Logger.WARNING)
+
+        model = truncate_resnet(cnn, layer)
+        x = torch.zeros(batch_size, 3, width, width, device='cuda')
+        out_shape = model(x).shape
+
+        # Export the static graph to ONNX
+        onnx_model = io.BytesIO()
+        torch.onnx.export(model, x, onnx_model,
+                          input_names=['input'], output_names=['output'])
+
+        builder = trt.Builder(self.logger)
+        network = builder.create_network(
+            1 << int(trt.NetworkDefinitionCreationFlag.EXPLICIT_BATCH))
+        parser = trt.OnnxParser(network, self.logger)
+        if not parser.parse(onnx_model.getvalue()):
+            errors = [str(parser.get_error(i)) for i in range(parser.num_errors)]
+            raise RuntimeError('ONNX parsing failed: {}'.format(errors))
+
+        config = builder.create_builder_config()
+        config.set_flag(trt.BuilderFlag.FP16)
+        engine = builder.build_serialized_network(network, config)
+        if engine is None:
+            raise RuntimeError('Could not build the TensorRT engine.')
+
+        self.engine = trt.Runtime(self.logger).deserialize_cuda_engine(engine)
+        self.context = self.engine.create_execution_context()
+
+        # Static device buffers bound to the engine once
+        self.inp = torch.zeros_like(x)
+        self.out = torch.empty(out_shape, device='cuda')
+        self.context.set_tensor_address('input', self.inp.data_ptr())
+        self.context.set_tensor_address('output', self.out.data_ptr())
+
+    def __call__(self, cnn, x):
+        # cnn is unused, the signature is kept compatible with other extractors
+        n = x.shape[0]
+        self.inp[:n].copy_(x, non_blocking=True)
+        if n < self.batch_size:
+            self.inp[n:].zero_()
+        self.context.execute_async_v3(torch.cuda.current_stream().cuda_stream)
+        # The output buffer is overwritten by the next call
+        return self.out[:n].clone()
+
+
+def truncate_resnet(cnn, layer):
+    """Returns an ``nn.Sequential`` of ResNet-50 blocks up to ``layer``."""
+    blocks = [cnn.conv1, cnn.bn1, cnn.relu, cnn.maxpool,
+              cnn.layer1, cnn.layer2, cnn.layer3]
+    if layer in ('res5c_relu', 'avgpool'):
+        blocks.append(cnn.layer4)
+    if layer == 'avgpool':
+        blocks.extend([cnn.avgpool, nn.Flatten()])
+    return nn.Sequential(*blocks).eval()
+
+
 def resnet_forward(cnn, x):
     x = cnn.conv1(x)
     x = cnn.bn1(x)
@@ -112,6 +268,13 @@ def avgpool(cnn, x):
     return avgp.view(avgp.size(0), -1)
 
 
+def l2norm_fp16(out):
+    """L2-normalizes features along the channel axis in 32-bit and returns
+    them as FP16. For convolutional features, each spatial position is
+    normalized independently."""
+    return F.normalize(out.float(), dim=1).half()
+
+
 # python bin/extract.py -i /media/jb/DATA/sub/nmtpytorch/data/image_splits/val/val.txt  \
 #                   -f /media/jb/DATA/sub/nmtpytorch/data/image_splits/raw/flickr30k_images/ \
 #                   -s val
@@ -139,12 +302,26 @@ if __name__ == '__main__':
                         help='Apply l2 normalization.')
     parser.add_argument('-l', '--layer', default='res4f_relu',
                         help='res4f_relu/res5c_relu/avgpool')
+    parser.add_argument('-d', '--dali', action='store_true',
+                        help='Use NVIDIA DALI for GPU image preprocessing.')
+    parser.add_argument('-H', '--fp16', action='store_true',
+                        help='Run the CNN forward pass in FP16 (Tensor Cores).')
+    parser.add_argument('-j', '--num-workers', type=int,
+                        default=min(8, os.cpu_count()),
+                        help='Number of DataLoader worker processes.')
+    parser.add_argument('-t', '--trt', action='store_true',
+                        help='Run the CNN through a TensorRT FP16 engine.')
 
     # Parse arguments
     args = parser.parse_args()
 
+    # Inference only
+    torch.set_grad_enabled(False)
+
 
     bs = args.batch_size
+    if args.fp16 and bs % 8 != 0:
+        print('Warning: batch size should be a multiple of 8 for Tensor Cores.')
 
     resize_width = int(args.width / args.central_fraction)
     print('Resize shortest side to {} then center crop {}x{}'.format(
@@ -157,7 +334,18 @@ if __name__ == '__main__':
         args.index, args.folder, len(dataset)))
     n_batches = int(np.ceil(len(dataset) / bs))
 
-    loader = data.DataLoader(dataset, batch_size=args.batch_size)
+    if args.dali:
+        if not DALI_AVAILABLE:
+            raise RuntimeError('--dali requires nvidia-dali to be installed.')
+        # Decode on the same device as the CNN
+        loader = dali_loader(
+            dataset.image_files, bs, resize=resize_width, crop=args.width,
+            num_threads=max(1, args.num_workers),
+            device_id=torch.cuda.current_device())
+    else:
+        loader = data.DataLoader(
+            dataset, batch_size=args.batch_size, num_workers=args.num_workers,
+            pin_memory=True, persistent_workers=args.num_workers > 0)
 
     print('Creating CNN instance.')
     cnn = resnet50(pretrained=True)
@@ -167,43 +355,99 @@ if __name__ == '__main__':
 
     cnn.train(False)
 
-    x = Variable(torch.zeros(1, 3, args.width, args.width), volatile=True)
+    x = torch.zeros(1, 3, args.width, args.width)
+
+    # Output file
+    output = "{}-{}-{}-r{}-c{}".format(
+        args.split, 'resnet50', args.layer, resize_width, args.width)
+    if args.l2norm:
+        output += '-l2norm'
 
     # Create placeholders
     if args.layer == 'avgpool':
-        feats = np.zeros((len(dataset), 2048), dtype='float32')
+        shape = (len(dataset), 2048)
         extractor = avgpool
     elif args.layer == 'res4f_relu':
         extractor = res4f_relu
         w = extractor(cnn, x).shape[-1]
         print('Output spatial dimensions: {}x{}'.format(w, w))
-        feats = np.zeros((len(dataset), 1024, w, w), dtype='float32')
+        shape = (len(dataset), 1024, w, w)
     elif args.layer == 'res5c_relu':
         extractor = res5c_relu
         w = extractor(cnn, x).shape[-1]
         print('Output spatial dimensions: {}x{}'.format(w, w))
-        feats = np.zeros((len(dataset), 2048, w, w), dtype='float32')
+        shape = (len(dataset), 2048, w, w)
+
+    # Stream the features to a memory-mapped .npy file instead of
+    # keeping the whole array in memory. It is written under a temporary
+    # name so that an interrupted run does not leave a valid-looking file.
+    feats = np.lib.format.open_memmap(
+        output + '.tmp.npy', mode='w+', dtype='float16', shape=shape)
 
     cnn.cuda()
 
-    for bidx, batch in enumerate(loader):
-        x = Variable(batch, volatile=True).cuda()
-        out = extractor(cnn, x)
+    # Let cuDNN pick the fastest (Tensor Core) algorithms for fixed shapes
+    torch.backends.cudnn.benchmark = True
 
-        if args.l2norm:
-            if out.dim() == 2:
-                out = F.normalize(out, dim=-1)
-            else:
-                n, c, h, w = out.shape
-                out = F.normalize(out.view(n, c, -1), dim=1).view(n, c, h, w)
+    if args.trt:
+        if not TRT_AVAILABLE:
+            raise RuntimeError('--trt requires tensorrt to be installed.')
+        print('Building TensorRT engine.')
+        extractor = TensorRTExtractor(cnn, args.layer, bs, args.width)
+        # The engine handles FP16 internally and expects NCHW inputs
+        args.fp16 = False
 
-            feats[bidx * bs: (bidx + 1) * bs] = out.data.cpu()
+    # Tensor Core convolutions operate natively on NHWC tensors
+    memory_format = torch.channels_last if args.fp16 else torch.contiguous_format
+    cnn = cnn.to(memory_format=memory_format)
+
+    if args.l2norm:
+        # Fuse normalization and FP16 cast into a single kernel
+        postprocess = torch.compile(l2norm_fp16)
+    else:
+        postprocess = torch.Tensor.half
+
+    # Double-buffered pinned staging tensors and a side stream so that the
+    # D2H copy of a batch overlaps with the computation of the next one
+    copy_stream = torch.cuda.Stream()
+    copy_done = [torch.cuda.Event(), torch.cuda.Event()]
+    staging = None
+    pending = None
+
+    for bidx, batch in enumerate(loader):
+        x = batch.cuda(non_blocking=True).contiguous(memory_format=memory_format)
+        with torch.cuda.amp.autocast(enabled=args.fp16, dtype=torch.float16):
+            out = extractor(cnn, x)
+
+        # Download FP16 features to halve the transfer size
+        out = postprocess(out)
+
+        if staging is None:
+            staging = [torch.empty((bs, ) + out.shape[1:], dtype=torch.float16,
+                                   pin_memory=True) for _ in range(2)]
+
+        slot = bidx % 2
+        copy_stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(copy_stream):
+            staging[slot][:out.shape[0]].copy_(out, non_blocking=True)
+            copy_done[slot].record()
+        out.record_stream(copy_stream)
+
+        # Write back the previous batch while the GPU works on this one
+        if pending is not None:
+            pslot, start, n = pending
+            copy_done[pslot].synchronize()
+            feats[start: start + n] = staging[pslot][:n].numpy()
+        pending = (slot, bidx * bs, out.shape[0])
 
         print('{:3}/{:3} batches completed.'.format(bidx + 1, n_batches), end='\r')
 
-    # Save the file
-    output = "{}-{}-{}-r{}-c{}".format(
-        args.split, 'resnet50', args.layer, resize_width, args.width)
-    if args.l2norm:
-        output += '-l2norm'
-    np.save(output, feats.astype('float16'))
\ No newline at end of file
+    if pending is not None:
+        pslot, start, n = pending
+        copy_done[pslot].synchronize()
+        feats[start: start + n] = staging[pslot][:n].numpy()
+
+    # Flush the remaining pages to disk and move the file into place
+    feats.flush()
+    del feats
+    os.replace(output + '.tmp.npy', output + '.npy')
\ No newline at end of file
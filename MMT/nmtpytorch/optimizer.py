@@ -3,7 +3,7 @@ import logging
 
 import torch.optim
 from torch.optim.lr_scheduler import ReduceLROnPlateau
-from torch.nn.utils.clip_grad import clip_grad_norm
+from torch.nn.utils import clip_grad_norm_
 
 logger = logging.getLogger('nmtpytorch')
 
@@ -65,22 +65,32 @@ class Optimizer(object):
         self.named_params = self.get_params(self.model)
 
         # Filter out names for gradient clipping
-        self.params = [param for (name, param) in self.named_params]
-        # for (name, param) in self.named_params:
-        #     print(name)
+        self.params = tuple(param for (name, param) in self.named_params)
+
+        # Split parameters in a single pass. Discriminator parameters are
+        # not optimized here. Biases are detected through the last name
+        # component, i.e. `.bias` but also RNN's `.bias_ih_l0` and such.
+        weights, biases = [], []
+        for name, param in self.named_params:
+            if "discriminator" in name:
+                continue
+            elif name.rsplit('.', 1)[-1].startswith('bias'):
+                biases.append(param)
+            else:
+                weights.append(param)
 
         if self.weight_decay > 0:
             weight_group = {
-                'params': [p for n, p in self.named_params if 'bias' not in n and "discriminator" not in n],
+                'params': weights,
                 'weight_decay': self.weight_decay,
             }
             bias_group = {
-                'params': [p for n, p in self.named_params if 'bias' in n and "discriminator" not in n],
+                'params': biases,
             }
             self.param_groups = [weight_group, bias_group]
 
         else:
-            self.param_groups = [{'params':  [param for (name, param) in self.named_params if "discriminator" not in name]}]
+            self.param_groups = [{'params': weights + biases}]
 
         # Safety check
         n_params = len(self.params)
@@ -115,7 +125,7 @@ class Optimizer(object):
 
     def _step(self, closure=None):
         """Gradient clipping aware step()."""
-        clip_grad_norm(self.params, self.gclip)
+        clip_grad_norm_(self.params, self.gclip)
         self.optim.step(closure)
 
     def lr_step(self, metric):
@@ -1,22 +1,255 @@
 # -*- coding: utf-8 -*-
+import functools
+
 import torch
-from torch.autograd import Variable
 
 from .utils.misc import pbar
 from .utils.topology import Topology
 
 
-def tile_ctx_dict(ctx_dict, idxs):
-    """Returns dict of 3D tensors repeatedly indexed along the sample axis."""
-    # 1st: tensor, 2nd optional mask
+def _index_samples(t, idxs, buffers, key):
+    """Indexes ``t`` along the sample axis into a reusable buffer."""
+    size = list(t.shape)
+    size[1] = idxs.numel()
+    numel = torch.Size(size).numel()
+
+    buf = buffers.get(key)
+    if buf is None or buf.dtype != t.dtype or buf.numel() < numel:
+        # (Re)allocate flat storage large enough for this batch
+        buf = buffers[key] = t.new_empty(numel)
+    return torch.index_select(t, 1, idxs, out=buf[:numel].view(size))
+
+
+def tile_ctx_dict(ctx_dict, idxs, buffers=None):
+    """Returns dict of 3D tensors repeatedly indexed along the sample axis.
+
+    If a ``buffers`` dictionary is given, the results are written into
+    storage kept in it and reused across calls instead of new tensors.
+    """
+    if buffers is None:
+        # 1st: tensor, 2nd optional mask
+        return {
+            k: (t[:, idxs], None if mask is None else mask[:, idxs])
+            for k, (t, mask) in ctx_dict.items()
+        }
+
     return {
-        k: (t[:, idxs], None if mask is None else mask[:, idxs])
+        k: (_index_samples(t, idxs, buffers, (k, 'ctx')),
+            None if mask is None else _index_samples(
+                mask, idxs, buffers, (k, 'mask')))
         for k, (t, mask) in ctx_dict.items()
     }
 
 
+def beam_select(log_ps, nll, lens, nk_mask, eos_mask, k, n_vocab,
+                beam_stride, eos, unk, suppress_unk, count_len=True,
+                inf=-1000):
+    """Selects the k-best continuations from the decoders' log-probabilities.
+
+    This is the elementwise/top-k tail of a decoding step and is compiled
+    on its own by ``beam_search``. If ``count_len`` is ``False``, the
+    selected tokens do not count towards the hypothesis lengths.
+
+    Returns:
+        tuple:
+            Accumulated negative log-likelihoods, hypothesis lengths, current
+            token indices, indices of the previous beams (backpointers) and
+            the tiling indices for the next step.
+    """
+    batch_size = nll.shape[0]
+
+    # Do the actual averaging of log-probabilities
+    # Small differences matter for beam ordering, keep them in 32-bit
+    log_p = sum(log_p.float() for log_p in log_ps)
+    if suppress_unk:
+        log_p[:, unk] = inf
+
+    # Unfavor all candidates of <eos>'d hyps
+    log_p.masked_fill_(eos_mask.unsqueeze(1), inf)
+    # Favor <eos> so that it gets selected
+    log_p[:, eos].masked_fill_(eos_mask, 0)
+
+    # Expand to 3D, cross-sum scores and reduce back to 2D
+    # log_p: batch_size x vocab_size ( t = 0 )
+    #   nll: batch_size x beam_size (x 1)
+    # nll becomes: batch_size x beam_size*vocab_size here
+    # Reduce (N, K*V) to k-best
+    nll, beam_t = nll.unsqueeze(2).add(log_p.view(
+        batch_size, -1, n_vocab)).view(batch_size, -1).topk(
+        k, sorted=False, largest=True)
+
+    # previous indices into the beam and current token indices
+    pdxs = beam_t.div(n_vocab, rounding_mode='floor')
+    beam_t = beam_t.remainder(n_vocab)
+
+    # Update hypothesis lengths by counting tokens not in (pad,bos,eos)
+    lens = lens.gather(1, pdxs)
+    if count_len:
+        lens = lens + beam_t.gt(2).float()
+
+    # Compute correct previous indices
+    # Mask is needed since we're in flattened regime
+    tile = pdxs.view(-1) + nk_mask * beam_stride
+
+    return nll, lens, beam_t, pdxs, tile
+
+
+def beam_step(f_nexts, decs, ctx_dicts, h_ts, y_t, tile, nll, lens, nk_mask,
+              eos_mask, k, n_vocab, beam_stride, eos, unk, suppress_unk,
+              count_len=True, fp16=False, streams=None, select=beam_select):
+    """Performs a single decoding step of ``beam_search``.
+
+    This function does not contain any data-dependent control flow so that
+    it can be captured into a CUDA graph. Finished hypotheses are handled
+    through ``eos_mask`` while the early-exit check is left to the caller.
+    If ``fp16`` is ``True``, the decoders run under FP16 autocast while
+    scores and decoder states are kept in 32-bit. For ensembles,
+    ``streams`` provides one CUDA stream per model so that the decoders run
+    concurrently. The stream dispatch is kept out of ``torch.compile``,
+    which only sees the individual ``f_nexts`` and the ``select`` function.
+
+    Returns:
+        tuple:
+            New decoder states followed by the outputs of ``select``.
+    """
+    # Get log probabilities and next state
+    # log_p: batch_size x vocab_size (t = 0)
+    #        batch_size*beam_size x vocab_size (t > 0)
+    with torch.cuda.amp.autocast(enabled=fp16, dtype=torch.float16):
+        if streams is None:
+            log_ps, new_h_ts = zip(
+                *[f_next(cd, dec.emb(y_t), h_t[tile]) for
+                    f_next, dec, cd, h_t in zip(f_nexts, decs, ctx_dicts, h_ts)])
+        else:
+            # Fork each model onto its own stream and join them back
+            current = torch.cuda.current_stream()
+            outs = []
+            for stream, f_next, dec, cd, h_t in zip(
+                    streams, f_nexts, decs, ctx_dicts, h_ts):
+                stream.wait_stream(current)
+                with torch.cuda.stream(stream):
+                    outs.append(f_next(cd, dec.emb(y_t), h_t[tile]))
+            for stream in streams:
+                current.wait_stream(stream)
+            log_ps, new_h_ts = zip(*outs)
+
+    # GRU cells return FP16 states under autocast, keep the recurrent
+    # state in the precision given by f_init
+    h_ts = [new_h_t.to(h_t.dtype) for new_h_t, h_t in zip(new_h_ts, h_ts)]
+
+    return (h_ts, ) + select(
+        log_ps, nll, lens, nk_mask, eos_mask, k, n_vocab, beam_stride,
+        eos, unk, suppress_unk, count_len)
+
+
+class BeamStepGraph(object):
+    """Replays a decoding step function from CUDA graphs.
+
+    Once the beam is expanded (t > 0), shapes and control flow of a decoding
+    step only depend on the number of hypotheses and the source lengths, so
+    a graph is captured once per such shape and replayed afterwards, across
+    batches. This removes the launch overhead of the many small kernels
+    involved.
+
+    Source contexts are copied into static buffers shared by all graphs,
+    only when they change, i.e. once per batch and shape. Decoder states
+    and the small per-step tensors are copied before each replay. The
+    mask of sample indices is constant and is used by reference.
+
+    All graphs share a memory pool. This is safe as only one graph runs at
+    a time and its outputs are consumed before the next replay.
+
+    Arguments:
+        step (callable): A function with the signature of ``beam_step``.
+    """
+    def __init__(self, step):
+        self.step = step
+        self.graphs = {}
+        self.pool = torch.cuda.graph_pool_handle()
+        # Flat storage for the static source contexts
+        self.buffers = {}
+        # Key and contexts of the last replay
+        self._last = (None, None)
+
+    def _static_view(self, t, key):
+        buf = self.buffers.get(key)
+        if buf is None or buf.dtype != t.dtype or buf.numel() < t.numel():
+            # Existing graphs read from the old storage, recapture them
+            self.graphs.clear()
+            buf = self.buffers[key] = t.new_empty(t.numel())
+        return buf[:t.numel()].view(t.shape)
+
+    def _static_ctx_dicts(self, ctx_dicts):
+        return [
+            {name: (self._static_view(t, (i, name, 'ctx')),
+                    None if mask is None else self._static_view(
+                        mask, (i, name, 'mask')))
+             for name, (t, mask) in ctx_dict.items()}
+            for i, ctx_dict in enumerate(ctx_dicts)]
+
+    @staticmethod
+    def _copy_ctx_dicts(dsts, srcs):
+        for dst, src in zip(dsts, srcs):
+            for name, (t, mask) in src.items():
+                dst[name][0].copy_(t)
+                if mask is not None:
+                    dst[name][1].copy_(mask)
+
+    def _capture(self, f_nexts, decs, ctx_dicts, h_ts, nk_mask, tensors,
+                 args):
+        s_ctx_dicts = self._static_ctx_dicts(ctx_dicts)
+        self._copy_ctx_dicts(s_ctx_dicts, ctx_dicts)
+        s_h_ts = [h_t.clone() for h_t in h_ts]
+        s_tensors = [t.clone() for t in tensors]
+
+        def run():
+            return self.step(f_nexts, decs, s_ctx_dicts, s_h_ts,
+                             *s_tensors[:4], nk_mask, *s_tensors[4:], *args)
+
+        # Warm up on a side stream before capturing
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(3 if not self.graphs else 1):
+                run()
+        torch.cuda.current_stream().wait_stream(stream)
+
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph, pool=self.pool):
+            outputs = run()
+
+        return graph, s_ctx_dicts, s_h_ts + s_tensors, outputs
+
+    def __call__(self, f_nexts, decs, ctx_dicts, h_ts, y_t, tile, nll, lens,
+                 nk_mask, eos_mask, *args):
+        tensors = (y_t, tile, nll, lens, eos_mask)
+        # Shapes follow from the number of hypotheses and source lengths
+        key = (h_ts[0].shape[0], ) + tuple(
+            t.shape[0] for ctx_dict in ctx_dicts
+            for t, _ in ctx_dict.values()) + args
+
+        if key not in self.graphs:
+            # Static inputs are initialized from the current ones
+            self.graphs[key] = self._capture(
+                f_nexts, decs, ctx_dicts, h_ts, nk_mask, tensors, args)
+            graph, _, _, outputs = self.graphs[key]
+        else:
+            graph, s_ctx_dicts, inputs, outputs = self.graphs[key]
+            # Contexts are constant within a batch and shape
+            if self._last[0] != key or self._last[1] is not ctx_dicts:
+                self._copy_ctx_dicts(s_ctx_dicts, ctx_dicts)
+            for dst, src in zip(inputs, list(h_ts) + list(tensors)):
+                dst.copy_(src)
+
+        self._last = (key, ctx_dicts)
+        graph.replay()
+        return outputs
+
+
+@torch.no_grad()
 def beam_search(models, data_loader, task_id=None, beam_size=12, max_len=200,
-                lp_alpha=0., suppress_unk=False):
+                lp_alpha=0., suppress_unk=False, fp16=False,
+                cuda_graphs=False, compile=False):
     """An efficient GPU implementation for beam-search algorithm.
 
     Arguments:
@@ -33,6 +266,15 @@ def beam_search(models, data_loader, task_id=None, beam_size=12, max_len=200,
             lp: ((5 + |Y|)^lp_alpha / (5 + 1)^lp_alpha)
         suppress_unk (bool, optional): If `True`, suppresses the log-prob
             of <unk> token.
+        fp16 (bool, optional): If `True`, runs the decoders under FP16
+            autocast to make use of Tensor Cores. (Default: False)
+        cuda_graphs (bool, optional): If `True`, steps t > 0 are replayed
+            from CUDA graphs captured once per number of hypotheses and
+            source length and reused across batches.
+            (Default: False)
+        compile (bool, optional): If `True`, the decoders and the beam
+            selection are compiled with ``torch.compile``. This requires a
+            working Inductor/Triton setup. (Default: False)
 
     Returns:
         list:
@@ -43,7 +285,6 @@ def beam_search(models, data_loader, task_id=None, beam_size=12, max_len=200,
     # batches, efficient batch-size will be <= max_batch_size
     max_batch_size = data_loader.batch_sampler.batch_size
     k = beam_size
-    inf = -1000
     results = []
     enc_args = {}
 
@@ -72,26 +313,68 @@ def beam_search(models, data_loader, task_id=None, beam_size=12, max_len=200,
     eos = vocab['<eos>']
     n_vocab = len(vocab)
 
+    # Ensemble members are decoded concurrently on separate streams
+    streams = None
+    if len(models) > 1:
+        streams = tuple(torch.cuda.Stream() for _ in models)
+
+    step = beam_step
+    if compile:
+        # Compile the decoders and the selection separately so that the
+        # stream dispatch for ensembles stays in eager mode. Shapes vary
+        # across batches, hence the dynamic compilation.
+        f_nexts = [torch.compile(f_next, dynamic=True) for f_next in f_nexts]
+        step = functools.partial(
+            beam_step, select=torch.compile(beam_select, dynamic=True))
+    # Optionally replay steps t > 0 from CUDA graphs
+    graph_step = BeamStepGraph(step) if cuda_graphs else step
+
+    # Drop finished samples from the decoding tensors every few steps so
+    # that the cost of late steps depends on the number of remaining ones
+    shrink_every = 8
+
     # Tensorized beam that will shrink and grow up to max_batch_size
+    # Each step stores the selected tokens and the indices of the beams
+    # they extend (backpointers), hypotheses are only assembled at the end.
     beam_storage = torch.zeros((max_len, max_batch_size, k)).long().cuda()
-    mask = torch.arange(max_batch_size * k).long().cuda()
+    bp_storage = torch.zeros((max_len, max_batch_size, k)).long().cuda()
+    # Backpointers for steps not performed by a sample keep the beam order
+    bp_identity = torch.arange(k).long().cuda()
+    # Sample index of each flattened hypothesis
+    mask = torch.arange(max_batch_size * k).long().cuda().div(
+        k, rounding_mode='floor')
     nll_storage = torch.zeros(max_batch_size).cuda()
+    # Final scores and lengths of hypotheses, filled as samples finish
+    score_storage = torch.zeros((max_batch_size, k)).cuda()
+    len_storage = torch.zeros((max_batch_size, k)).cuda()
+    # Reusable storage for the source contexts tiled to the beam
+    ctx_buffers = [{} for _ in models]
 
     for batch in pbar(data_loader, unit='batch'):
         # Send to GPU
-        batch.to_gpu(volatile=True)
+        batch.to_gpu()
 
         # Always use the initial storage
         beam = beam_storage.narrow(1, 0, batch.size).zero_()
+        bp = bp_storage.narrow(1, 0, batch.size)
+        bp.copy_(bp_identity.expand_as(bp))
+        scores = score_storage.narrow(0, 0, batch.size)
+        lengths = len_storage.narrow(0, 0, batch.size)
+
+        # Finished samples are periodically dropped from the decoding
+        # tensors, keep track of the remaining ones and their results
+        out_beam, out_bp = beam, bp
+        orig_idxs = torch.arange(batch.size, device='cuda')
 
         # Mask to apply to pdxs.view(-1) to fix indices
         nk_mask = mask.narrow(0, 0, batch.size * k)
 
         # nll: batch_size x 1 (will get expanded further)
         nll = nll_storage.narrow(0, 0, batch.size).unsqueeze(1)
+        lens = torch.zeros_like(nll)
 
         # Tile indices to use in the loop to expand first dim
-        tile = range(batch.size)
+        tile = torch.arange(batch.size, device='cuda')
 
         # Encode source modalities
         ctx_dicts = [encode(batch, **enc_args) for encode in encoders]
@@ -102,65 +385,85 @@ def beam_search(models, data_loader, task_id=None, beam_size=12, max_len=200,
         # Start with <bos> tokens
         # FIXME: idxs should not change except for informed <bos> embeddings
         idxs = models[0].get_bos(batch.size).cuda()
+        n_steps = 0
 
         for t in range(max_len):
-            # Fetch embs for the next iteration (N*K, E)
-            # y_ts = [m.dec.emb(Variable(idxs, volatile=True).cuda()) for m in models]
-            y_t = Variable(idxs, volatile=True).cuda()
-
-            # Select correct positions from source context
-            ctx_dicts = [tile_ctx_dict(cd, tile) for cd in ctx_dicts]
-
-            # Get log probabilities and next state
-            # log_p: batch_size x vocab_size (t = 0)
-            #        batch_size*beam_size x vocab_size (t > 0)
-            log_ps, h_ts = zip(
-                *[f_next(cd, dec.emb(y_t), h_t[tile]) for
-                    f_next, dec, cd, h_t in zip(f_nexts, decs, ctx_dicts, h_ts)])
-
-            # Do the actual averaging of log-probabilities
-            log_p = sum(log_ps).data
-            if suppress_unk:
-                log_p[:, unk] = inf
+            # Tokens to embed for the next iteration (N*K)
+            y_t = idxs
 
             # Detect <eos>'d hyps
-            idxs = (idxs == 2).nonzero()
-            if idxs.numel():
-                if idxs.numel() == batch.size * k:
-                    break
-                idxs.squeeze_(-1)
-                # Unfavor all candidates
-                log_p.index_fill_(0, idxs, inf)
-                # Favor <eos> so that it gets selected
-                log_p.view(-1).index_fill_(0, idxs * n_vocab + 2, 0)
-
-            # Expand to 3D, cross-sum scores and reduce back to 2D
-            # log_p: batch_size x vocab_size ( t = 0 )
-            #   nll: batch_size x beam_size (x 1)
-            # nll becomes: batch_size x beam_size*vocab_size here
-            # Reduce (N, K*V) to k-best
-            nll, beam[t] = nll.unsqueeze_(2).add(log_p.view(
-                batch.size, -1, n_vocab)).view(batch.size, -1).topk(
-                k, sorted=False, largest=True)
-
-            # previous indices into the beam and current token indices
-            pdxs = beam[t] / n_vocab
-            beam[t].remainder_(n_vocab)
+            eos_mask = idxs == eos
+            if eos_mask.all():
+                break
+
+            if t > 0 and t % shrink_every == 0:
+                # Samples for which all hypotheses generated <eos>
+                finished = eos_mask.view(-1, k).all(1)
+                live = (~finished).nonzero().view(-1)
+                # Shrink to power of two sizes only, so that the number of
+                # distinct step shapes (and CUDA graphs) stays small.
+                # Finished samples pad the batch up to that size.
+                n_keep = 1 << (live.numel() - 1).bit_length()
+                if n_keep < finished.numel():
+                    fin = finished.nonzero().view(-1)
+                    keep = torch.cat((live, fin[:n_keep - live.numel()]))
+                    drop = fin[n_keep - live.numel():]
+
+                    # Store the results of dropped samples
+                    out_beam[:, orig_idxs[drop]] = beam[:, drop]
+                    out_bp[:, orig_idxs[drop]] = bp[:, drop]
+                    scores[orig_idxs[drop]] = nll[drop]
+                    lengths[orig_idxs[drop]] = lens[drop]
+
+                    # Select the rows of the kept hypotheses
+                    rows = (keep.unsqueeze(1) * k + torch.arange(
+                        k, device=keep.device)).view(-1)
+                    orig_idxs = orig_idxs[keep]
+                    beam = beam[:, keep]
+                    bp = bp[:, keep]
+                    nll = nll[keep]
+                    lens = lens[keep]
+                    eos_mask = eos_mask[rows]
+                    y_t = y_t[rows]
+                    h_ts = [h_t[rows] for h_t in h_ts]
+                    ctx_dicts = [tile_ctx_dict(cd, rows) for cd in ctx_dicts]
+                    nk_mask = mask.narrow(0, 0, n_keep * k)
+                    tile = pdxs[keep].view(-1) + nk_mask * k
+
+            if t == 1:
+                # Expand source contexts to the beam. Since all hypotheses
+                # of a sample share the same context, later tilings would
+                # leave them unchanged and are thus skipped.
+                ctx_dicts = [tile_ctx_dict(cd, tile, buf) for cd, buf in
+                             zip(ctx_dicts, ctx_buffers)]
+
+            # The token selected at the last step is replaced by <eos>
+            # and is thus not counted. That step bypasses the CUDA graphs
+            # so that it does not capture a graph of its own.
+            last = t == max_len - 1
+            h_ts, nll, lens, beam[t], bp[t], tile = (
+                graph_step if 0 < t and not last else step)(
+                f_nexts, decs, ctx_dicts, h_ts, y_t, tile, nll, lens,
+                nk_mask, eos_mask, k, n_vocab, k if t else 1, eos, unk,
+                suppress_unk, not last, fp16, streams)
+            pdxs = bp[t]
             idxs = beam[t].view(-1)
+            n_steps = t + 1
 
-            # Compute correct previous indices
-            # Mask is needed since we're in flattened regime
-            tile = pdxs.view(-1) + (nk_mask / k) * (k if t else 1)
-
-            if t > 0:
-                # Permute all hypothesis history according to new order
-                beam[:t] = beam[:t].gather(2, pdxs.repeat(t, 1, 1))
+        # Store the results of the remaining samples
+        if beam is not out_beam:
+            out_beam[:, orig_idxs] = beam
+            out_bp[:, orig_idxs] = bp
+            beam, bp = out_beam, out_bp
+        scores[orig_idxs] = nll
+        lengths[orig_idxs] = lens
+        nll = scores
 
         # Put an explicit <eos> to make idxs_to_sent happy
         beam[max_len - 1] = eos
 
-        # Find lengths by summing tokens not in (pad,bos,eos)
-        lp = beam.gt(2).float().sum(0).clamp(min=1)
+        # Lengths exclude (pad,bos,eos)
+        lp = lengths.clamp(min=1)
 
         if lp_alpha > 0.:
             lp = ((5 + lp)**lp_alpha) / 6**lp_alpha
@@ -169,9 +472,16 @@ def beam_search(models, data_loader, task_id=None, beam_size=12, max_len=200,
         top_hyps = nll.div_(lp).topk(
             1, sorted=False, largest=True)[1].squeeze(1)
 
-        # Get best hyp for each sample in the batch
-        hyps = beam[:, range(batch.size), top_hyps].t().cpu()
-        results.extend(vocab.list_of_idxs_to_sents(hyps.tolist()))
+        # Get best hyp for each sample in the batch by following
+        # the backpointers from the last step
+        samples = torch.arange(batch.size, device='cuda')
+        hyps = torch.zeros_like(beam[:, :, 0])
+        hyps[max_len - 1] = eos
+        for t in reversed(range(n_steps)):
+            hyps[t] = beam[t, samples, top_hyps]
+            top_hyps = bp[t, samples, top_hyps]
+        hyps = hyps.t().int().cpu()
+        results.extend(vocab.idxs_to_sent_array(hyps.numpy()))
 
     # Recover order of the samples if necessary
     if getattr(data_loader.batch_sampler, 'store_indices', False):
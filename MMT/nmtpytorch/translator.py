@@ -137,7 +137,9 @@ class Translator(object):
         start = time.time()
         hyps = beam_search(self.instances, loader, task_id=self.task_id,
                            beam_size=self.beam_size, max_len=self.max_len,
-                           lp_alpha=self.lp_alpha, suppress_unk=self.suppress_unk)
+                           lp_alpha=self.lp_alpha, suppress_unk=self.suppress_unk,
+                           fp16=self.fp16, cuda_graphs=self.cuda_graphs,
+                           compile=self.compile)
         up_time = time.time() - start
         logger.info('Took {:.3f} seconds, {} sent/sec'.format(
             up_time, math.floor(len(hyps) / up_time)))
@@ -4,6 +4,8 @@ import pathlib
 import logging
 from collections import OrderedDict
 
+import numpy as np
+
 logger = logging.getLogger('nmtpytorch')
 
 
@@ -21,6 +23,7 @@ class Vocabulary(object):
         self._map = None
         self._imap = None
         self._allmap = None
+        self._itable = None
         self.n_tokens = None
 
         self._map = json.load(open(self.vocab))
@@ -44,6 +47,11 @@ class Vocabulary(object):
         assert len(self._allmap) == (len(self._map) + len(self._imap)), \
             "Merged vocabulary size is not equal to sum of both."
 
+        # Index -> token lookup table for vectorized conversions
+        self._itable = np.array(
+            [self._imap.get(idx, "<unk>") for idx in range(max(self._imap) + 1)],
+            dtype=object)
+
     def __getitem__(self, key):
         return self._allmap[key]
 
@@ -94,6 +102,20 @@ class Vocabulary(object):
             results.append(" ".join(r))
         return results
 
+    def idxs_to_sent_array(self, arr):
+        """Convert a 2D integer array of hypotheses to list of strings.
+
+        This is a vectorized equivalent of ``list_of_idxs_to_sents`` where
+        each row is truncated at its first <eos>.
+        """
+        arr = np.asarray(arr)
+        is_eos = arr == self.TOKENS["<eos>"]
+        lens = np.where(is_eos.any(1), is_eos.argmax(1), arr.shape[1])
+        # Map out of range indices to <unk>
+        toks = self._itable[np.where(
+            arr < len(self._itable), arr, self.TOKENS["<unk>"])]
+        return [" ".join(row[:len_]) for row, len_ in zip(toks, lens)]
+
     def __repr__(self):
         return "Vocabulary of %d items (name=%s)" % (self.n_tokens,
                                                      self.name)
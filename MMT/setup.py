@@ -27,14 +27,14 @@ setuptools.setup(
         'Topic :: Scientific/Engineering',
         'License :: OSI Approved :: MIT License',
         'Programming Language :: Python :: 3 :: Only',
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3.8',
         'Operating System :: POSIX',
     ],
     keywords='nmt neural-mt translation sequence-to-sequence deep-learning pytorch',
-    python_requires='~=3.6',
+    python_requires='>=3.8',
     install_requires=[
         'numpy', 'scipy', 'scikit-learn', 'tqdm', 'pillow',
-        'torch==0.3.1', 'torchvision==0.2.1',
+        'torch>=2.1', 'torchvision>=0.16',
         'sacrebleu>=1.2.9', 'tensorboardX==1.1',
         'editdistance==0.4', 'subword_nmt==0.3.5',
     ],